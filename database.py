@@ -1,25 +1,146 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, ReturnDocument, UpdateOne, WriteConcern
+from pymongo.errors import AutoReconnect
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from urllib.parse import urlparse
+import functools
+import hashlib
 import logging
 import os
+import threading
 
 # --- Constants ---
 MONGO_URI = os.environ.get('MONGO_URI')
 DB_NAME = "wte-bot-db"
+BULK_WRITE_CHUNK_SIZE = 500
+BULK_WRITE_WORKERS = 8
 
 # --- Database Client ---
-client = MongoClient(MONGO_URI)
+# A single pooled client serves every concurrent update; idle sockets are
+# reaped after five minutes so bursts don't leave stale connections behind.
+client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=200,
+    minPoolSize=10,
+    maxIdleTimeMS=300_000,
+    # Tight timeouts so an unreachable server fails fast instead of stalling a worker.
+    serverSelectionTimeoutMS=3000,
+    connectTimeoutMS=3000,
+    socketTimeoutMS=5000,
+    retryWrites=True,
+    appname="wte-bot",
+)
 db = client[DB_NAME]
 
 # --- Collections ---
-user_settings = db["user_settings"]
-custom_parsers = db["custom_parsers"]
-repo_parsers = db["repo_parsers"] 
-log_channel = db["log_channel"]
+@functools.lru_cache(maxsize=None)
+def _coll(name: str):
+    """Returns a memoized handle for the named collection."""
+    return db[name]
+
+user_settings = _coll("user_settings")
+custom_parsers = _coll("custom_parsers")
+repo_parsers = _coll("repo_parsers")
+log_channel = _coll("log_channel")
+parsers_by_domain = _coll("parsers_by_domain")
+
+# Settings and custom parsers are cheap to redo from the UI, so their writes skip the
+# journal flush. The shared parser repository keeps a majority-acknowledged write.
+_fast_user_settings = user_settings.with_options(write_concern=WriteConcern(w=1, j=False))
+_fast_custom_parsers = custom_parsers.with_options(write_concern=WriteConcern(w=1, j=False))
+_durable_repo_parsers = repo_parsers.with_options(write_concern=WriteConcern(w="majority"))
+_durable_parsers_by_domain = parsers_by_domain.with_options(write_concern=WriteConcern(w="majority"))
 
 # --- Logging ---
 logger = logging.getLogger(__name__)
 
+# --- Retries ---
+# Transient connection drops are retried a few times with a short backoff.
+_retry_transient = retry(
+    retry=retry_if_exception_type(AutoReconnect),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.2),
+    reraise=True,
+)
+
+# --- Parser Lookup Caches ---
+# Every chapter of a book resolves the same host, so lookups are cached briefly.
+# Writers below clear these explicitly so new parsers show up immediately.
+PARSER_CACHE_TTL = 300
+_MISSING = object()
+_repo_script_cache = TTLCache(maxsize=512, ttl=PARSER_CACHE_TTL)
+_custom_parser_cache = TTLCache(maxsize=4096, ttl=PARSER_CACHE_TTL)
+_cache_lock = threading.Lock()
+
+def _cache_get(cache, key):
+    with _cache_lock:
+        return cache.get(key, _MISSING)
+
+def _cache_set(cache, key, value):
+    with _cache_lock:
+        cache[key] = value
+
+def _cache_clear(cache):
+    with _cache_lock:
+        cache.clear()
+
+# --- Hostnames ---
+
+def _normalize_host(hostname: str) -> str:
+    """Lowercases a hostname and strips a leading 'www.' so stored and queried forms match."""
+    return hostname.lower().removeprefix('www.')
+
+@functools.lru_cache(maxsize=4096)
+def _hostname_of(url: str):
+    """Returns the normalized hostname of a URL, or None if it has none."""
+    return _normalize_host(urlparse(url).hostname or "") or None
+
+# --- Domain Index ---
+# The parser repository is small (a few hundred parsers), so the whole
+# domain -> filename mapping is kept in memory and MongoDB is only asked for scripts.
+_DOMAIN_INDEX: dict = {}
+# False until a load succeeds, so a database outage at boot doesn't leave the index empty for good.
+_DOMAIN_INDEX_LOADED = False
+
+def _load_domain_index():
+    """(Re)loads the in-memory domain index from parsers_by_domain."""
+    global _DOMAIN_INDEX, _DOMAIN_INDEX_LOADED
+    try:
+        index = {doc["_id"]: doc["filename"] for doc in parsers_by_domain.find({}, {"filename": 1})}
+        if not index:
+            # Databases loaded before parsers_by_domain existed only have repo_parsers.
+            index = {
+                _normalize_host(d): doc["filename"]
+                for doc in repo_parsers.find({}, {"domains": 1, "filename": 1})
+                for d in doc.get("domains", [])
+            }
+        _DOMAIN_INDEX, _DOMAIN_INDEX_LOADED = index, True
+        logger.info(f"Loaded {len(index)} parser domains into memory.")
+    except Exception as e:
+        logger.error(f"Error loading the parser domain index: {e}", exc_info=True)
+
+# --- Indexes ---
+
+def _ensure_indexes():
+    """
+    Creates the indexes backing the lookups below. Set WTE_SKIP_INDEX_INIT
+    to skip this in worker processes that share an already-initialized database.
+    """
+    if os.environ.get("WTE_SKIP_INDEX_INIT"):
+        return
+    try:
+        user_settings.create_index([("user_id", ASCENDING)], unique=True)
+        custom_parsers.create_index([("user_id", ASCENDING), ("hostname", ASCENDING)], unique=True)
+        repo_parsers.create_index([("filename", ASCENDING)], unique=True)
+    except Exception as e:
+        logger.error(f"Error creating database indexes: {e}", exc_info=True)
+
+_ensure_indexes()
+_load_domain_index()
+
 # --- Settings Management (FIXED) ---
 
 def get_user_settings(user_id: int) -> dict:
@@ -35,107 +156,256 @@ def set_user_setting(user_id: int, key: str, value):
     Sets a specific setting for a user in the database.
     Creates the user's settings document if it doesn't exist.
     """
-    user_settings.update_one(
+    _fast_user_settings.update_one(
         {"user_id": user_id},
         {"$set": {key: value}},
         upsert=True
     )
 
+def update_and_get_user_settings(user_id: int, key: str, value) -> dict:
+    """
+    Sets a specific setting for a user and returns the updated settings document
+    in the same round-trip.
+    """
+    settings = _fast_user_settings.find_one_and_update(
+        {"user_id": user_id},
+        {"$set": {key: value}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        projection={"_id": 0}
+    )
+    return settings if settings else {}
+
+def toggle_and_get_user_setting(user_id: int, key: str, default: bool) -> dict:
+    """
+    Flips a boolean setting in a single update, treating a missing value as `default`,
+    and returns the updated settings document. Concurrent toggles can't overwrite each other.
+    """
+    settings = _fast_user_settings.find_one_and_update(
+        {"user_id": user_id},
+        [{"$set": {key: {"$not": [{"$ifNull": [f"${key}", default]}]}}}],
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        projection={"_id": 0}
+    )
+    return settings if settings else {}
+
 # --- Parser Management ---
 
 def get_parser_count():
-    """Returns the number of parsers in the database."""
-    return repo_parsers.count_documents({})
+    """Returns the (metadata-estimated) number of parsers in the database."""
+    return repo_parsers.estimated_document_count()
 
-def get_repo_parser(url: str):
+def get_repo_parser_meta_for_host(hostname: str):
     """
-    Finds a parser from the repository collection that matches the given URL's domain.
-    Handles 'www.' subdomains for more reliable matching.
+    Finds the repository parser registered for a normalized hostname, without its script.
+    Subdomains are handled by also matching parent domains.
     """
+    if not _DOMAIN_INDEX_LOADED:
+        _load_domain_index()
+    # Walk from the host itself up through its parent domains (e.g., 'm.example.com',
+    # then 'example.com') so the most specific registration wins.
+    parts = hostname.split('.')
+    for i in range(max(len(parts) - 1, 1)):
+        filename = _DOMAIN_INDEX.get('.'.join(parts[i:]))
+        if filename:
+            logger.info(f"Found repo parser for {hostname}: {filename}")
+            return {"filename": filename}
+    logger.info(f"No repo parser found for {hostname}")
+    return None
+
+@_retry_transient
+def _find_repo_parser_script(filename: str):
+    return repo_parsers.find_one({"filename": filename}, projection={"script": 1, "_id": 0})
+
+def get_repo_parser_script(filename: str):
+    """Fetches only the script body of a repository parser by its filename."""
+    cached = _cache_get(_repo_script_cache, filename)
+    if cached is not _MISSING:
+        return cached
     try:
-        hostname = urlparse(url).hostname
-        if not hostname:
-            return None
-            
-        # Create a list of possible domains to check (e.g., 'www.example.com' and 'example.com')
-        domains_to_check = [hostname]
-        if hostname.startswith('www.'):
-            domains_to_check.append(hostname[4:])
-            
-        # Query for a parser where its 'domains' array contains any of our possible domains.
-        parser = repo_parsers.find_one({"domains": {"$in": domains_to_check}})
-        
-        if parser:
-            logger.info(f"Found repo parser for {hostname}: {parser.get('filename')}")
-        else:
-            logger.info(f"No repo parser found for any of: {domains_to_check}")
-            
-        return parser
+        doc = _find_repo_parser_script(filename)
     except Exception as e:
-        logger.error(f"Error fetching repo parser for {url}: {e}", exc_info=True)
+        logger.error(f"Error fetching script for repo parser {filename}: {e}", exc_info=True)
         return None
+    script = doc.get("script") if doc else None
+    _cache_set(_repo_script_cache, filename, script)
+    return script
 
 def add_custom_parser(user_id: int, url: str, script_content: str):
     """Adds or updates a custom parser for a user."""
-    hostname = urlparse(url).hostname
+    hostname = _hostname_of(url)
     if not hostname:
         raise ValueError("Invalid URL provided.")
     
-    custom_parsers.update_one(
+    _fast_custom_parsers.update_one(
         {"user_id": user_id, "hostname": hostname},
         {"$set": {"script": script_content}},
         upsert=True
     )
+    _cache_clear(_custom_parser_cache)
     logger.info(f"Upserted custom parser for user {user_id} and host {hostname}")
 
-def get_custom_parser(user_id: int, url: str):
-    """Retrieves a user's custom parser for a given URL."""
-    hostname = urlparse(url).hostname
+@_retry_transient
+def _find_custom_parser(user_id: int, hostname: str):
+    return custom_parsers.find_one({"user_id": user_id, "hostname": hostname}, projection={"_id": 0, "script": 1})
+
+def _get_custom_parser_script(user_id: int, hostname: str):
+    """Fetches a user's custom parser script for a host, or None; absent parsers are cached too."""
+    key = (user_id, hostname)
+    cached = _cache_get(_custom_parser_cache, key)
+    if cached is not _MISSING:
+        return cached
+    doc = _find_custom_parser(user_id, hostname)
+    script = doc.get("script") if doc else None
+    _cache_set(_custom_parser_cache, key, script)
+    return script
+
+def resolve_parser(user_id: int, url: str):
+    """
+    Finds the parser to use for a user and URL: the user's custom parser if they
+    have one for the host, otherwise the repository parser. Warm lookups are served
+    from the TTL caches and the in-memory domain index without touching MongoDB.
+    """
+    hostname = _hostname_of(url)
     if not hostname:
         return None
-    return custom_parsers.find_one({"user_id": user_id, "hostname": hostname})
+    try:
+        script = _get_custom_parser_script(user_id, hostname)
+        if script is not None:
+            return {"filename": f"custom:{hostname}", "script": script}
+        meta = get_repo_parser_meta_for_host(hostname)
+        if not meta:
+            return None
+        script = get_repo_parser_script(meta["filename"])
+        if script is None:
+            return None
+        return {"filename": meta["filename"], "script": script}
+    except Exception as e:
+        logger.error(f"Error resolving parser for user {user_id} and {url}: {e}", exc_info=True)
+        return None
+
+@_retry_transient
+def _bulk_write_chunk(collection, operations: list):
+    return collection.bulk_write(operations, ordered=False, bypass_document_validation=True)
+
+def _bulk_write_chunked(collection, operations):
+    """
+    Splits bulk operations into chunks and writes them concurrently on a small pool.
+    Unordered writes let the server apply them in parallel and keep going past
+    individual failures. Operations are consumed lazily, with at most
+    BULK_WRITE_WORKERS chunks in flight, so a generator is never fully materialized.
+    """
+    operations = iter(operations)
+    results, in_flight = [], deque()
+    with ThreadPoolExecutor(max_workers=BULK_WRITE_WORKERS) as executor:
+        for chunk in iter(lambda: list(islice(operations, BULK_WRITE_CHUNK_SIZE)), []):
+            if len(in_flight) >= BULK_WRITE_WORKERS:
+                results.append(in_flight.popleft().result())
+            in_flight.append(executor.submit(_bulk_write_chunk, collection, chunk))
+        results.extend(f.result() for f in in_flight)
+    return results
+
+def _parser_sha(script: str, domains) -> str:
+    """Returns a short content hash of a parser's script and domains."""
+    digest = hashlib.blake2b(script.encode(), digest_size=16)
+    digest.update("\n".join(domains).encode())
+    return digest.hexdigest()
+
+def save_parsers_from_repo(parsers):
+    """
+    Upserts parsers into the repo_parsers collection, keyed by filename, and removes
+    any parser that is no longer among them. Each domain is also written to
+    parsers_by_domain, pointing at the parser's filename. Accepts any iterable and
+    makes a single pass over it, so scripts can be streamed in rather than listed.
+    Parsers whose script and domains hash the same as the stored copy are not rewritten.
+    """
+    filenames = []
+    domain_owners = {}
+    unchanged = 0
 
-def save_parsers_from_repo(parsers_list: list):
-    """Saves a list of parsers to the repo_parsers collection."""
-    if not parsers_list:
-        return 0
     try:
-        # Using insert_many for bulk operation
-        result = repo_parsers.insert_many(parsers_list, ordered=False)
-        return len(result.inserted_ids)
+        stored_shas = {doc["filename"]: doc.get("sha") for doc in repo_parsers.find({}, {"_id": 0, "filename": 1, "sha": 1})}
+        stored_domains = {doc["_id"]: doc["filename"] for doc in parsers_by_domain.find({}, {"filename": 1})}
     except Exception as e:
-        logger.error(f"Error during bulk save of repo parsers: {e}", exc_info=True)
-        return 0
+        logger.warning(f"Could not read stored parser hashes, rewriting every parser: {e}")
+        stored_shas, stored_domains = {}, {}
+
+    def upserts():
+        nonlocal unchanged
+        for p in parsers:
+            domains = sorted({_normalize_host(d) for d in p["domains"]})
+            filenames.append(p["filename"])
+            domain_owners.update(dict.fromkeys(domains, p["filename"]))
+            sha = _parser_sha(p["script"], domains)
+            if stored_shas.get(p["filename"]) == sha:
+                unchanged += 1
+                continue
+            yield UpdateOne({"filename": p["filename"]}, {"$set": {**p, "domains": domains, "sha": sha}}, upsert=True)
 
-def clean_all_parsers():
-    """Removes all documents from the repo_parsers collection."""
     try:
-        result = repo_parsers.delete_many({})
-        logger.info(f"Cleaned {result.deleted_count} parsers from the repository collection.")
-        return result.deleted_count
+        # Upserting in place avoids rebuilding the indexes from an emptied collection.
+        results = _bulk_write_chunked(_durable_repo_parsers, upserts())
+        if not filenames:
+            return 0
+        if not stored_shas.keys() <= set(filenames):
+            _durable_repo_parsers.delete_many({"filename": {"$nin": filenames}})
+
+        _bulk_write_chunked(_durable_parsers_by_domain, (
+            UpdateOne({"_id": domain}, {"$set": {"filename": filename}}, upsert=True)
+            for domain, filename in domain_owners.items()
+            if stored_domains.get(domain) != filename
+        ))
+        if not stored_domains.keys() <= domain_owners.keys():
+            _durable_parsers_by_domain.delete_many({"_id": {"$nin": list(domain_owners)}})
+
+        saved = sum(r.upserted_count + r.matched_count for r in results)
+        logger.info(f"Repo parsers: {saved} written, {unchanged} unchanged.")
+        return saved + unchanged
     except Exception as e:
-        logger.error(f"Error cleaning repo parsers: {e}", exc_info=True)
+        logger.error(f"Error during bulk save of repo parsers: {e}", exc_info=True)
         return 0
+    finally:
+        _load_domain_index()
+        _cache_clear(_repo_script_cache)
 
 # --- General Database Functions ---
 
 def clean_database():
     """Wipes all collections in the database."""
+    global _LOG_CHANNEL_CACHE, _LOG_CHANNEL_LOADED
     deleted_counts = {}
-    for collection in [user_settings, custom_parsers, repo_parsers, log_channel]:
-        count = collection.delete_many({}).deleted_count
+    for collection in [user_settings, custom_parsers, repo_parsers, log_channel, parsers_by_domain]:
+        count = collection.estimated_document_count()
+        collection.drop()
         deleted_counts[collection.name] = count
+    _ensure_indexes()
+    _load_domain_index()
+    _cache_clear(_repo_script_cache)
+    _cache_clear(_custom_parser_cache)
+    _LOG_CHANNEL_CACHE, _LOG_CHANNEL_LOADED = None, True
     return deleted_counts
 
+# The log channel is read for every log message but changes only through /logc,
+# so it is read from the database once and kept in sync by the writers here.
+_LOG_CHANNEL_CACHE = None
+_LOG_CHANNEL_LOADED = False
+
 def set_log_channel(channel_id: str):
     """Sets or updates the log channel ID."""
+    global _LOG_CHANNEL_CACHE, _LOG_CHANNEL_LOADED
     log_channel.update_one(
         {"_id": "log_channel_config"},
         {"$set": {"channel_id": channel_id}},
         upsert=True
     )
+    _LOG_CHANNEL_CACHE, _LOG_CHANNEL_LOADED = channel_id, True
 
 def get_log_channel():
     """Retrieves the configured log channel ID."""
-    config = log_channel.find_one({"_id": "log_channel_config"})
-    return config.get("channel_id") if config else None
+    global _LOG_CHANNEL_CACHE, _LOG_CHANNEL_LOADED
+    if not _LOG_CHANNEL_LOADED:
+        config = log_channel.find_one({"_id": "log_channel_config"})
+        _LOG_CHANNEL_CACHE = config.get("channel_id") if config else None
+        _LOG_CHANNEL_LOADED = True
+    return _LOG_CHANNEL_CACHE
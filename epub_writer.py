@@ -0,0 +1,164 @@
+"""A minimal EPUB 3 writer that streams chapters into the archive as they arrive."""
+import io
+import re
+import threading
+import time
+import zipfile
+from html import escape
+
+import lxml.html
+from lxml import etree
+
+# Characters that are legal in HTML text but not in XML 1.0.
+_INVALID_XML_CHARS_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+# Tag and attribute names that can be written without a namespace prefix.
+_XML_NAME_RE = re.compile(r'[A-Za-z_][\w.\-]*\Z')
+_HTML_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+_CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+_XHTML_DOCUMENT = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{lang}" xml:lang="{lang}">
+<head><title>{title}</title></head>
+<body>{body}</body>
+</html>
+"""
+
+_CONTENT_OPF = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="id">{identifier}</dc:identifier>
+    <dc:title>{title}</dc:title>
+    <dc:language>{lang}</dc:language>
+    <dc:creator id="creator">{author}</dc:creator>
+    <meta property="dcterms:modified">{modified}</meta>
+  </metadata>
+  <manifest>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+{items}
+  </manifest>
+  <spine toc="ncx">
+    <itemref idref="nav"/>
+{itemrefs}
+  </spine>
+</package>
+"""
+
+_TOC_NCX = """<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head>
+    <meta name="dtb:uid" content="{identifier}"/>
+    <meta name="dtb:depth" content="1"/>
+    <meta name="dtb:totalPageCount" content="0"/>
+    <meta name="dtb:maxPageNumber" content="0"/>
+  </head>
+  <docTitle><text>{title}</text></docTitle>
+  <navMap>
+{nav_points}
+  </navMap>
+</ncx>
+"""
+
+def _to_xhtml_body(html: str, remove_images: bool, remove_hyperlinks: bool) -> str:
+    """Parses chapter HTML and re-serializes the contents of its body as well-formed XHTML."""
+    html = _INVALID_XML_CHARS_RE.sub('', html)
+    if not html.strip():
+        return ''
+    body = lxml.html.document_fromstring(html.encode('utf-8'), parser=_HTML_PARSER).body
+    if remove_images:
+        for img in body.findall('.//img'):
+            img.drop_tree()
+    if remove_hyperlinks:
+        for link in body.findall('.//a'):
+            link.drop_tag()
+    for el in list(body.iter(etree.Element)):
+        if el is not body and not _XML_NAME_RE.match(el.tag):
+            # Prefixed tags such as Word's <o:p> have no namespace declaration here.
+            el.drop_tag()
+            continue
+        for name in [n for n in el.attrib if n == 'xmlns' or not _XML_NAME_RE.match(n)]:
+            del el.attrib[name]
+    parts = [escape(body.text or '', quote=False)]
+    parts.extend(etree.tostring(child, method='xml', encoding='unicode') for child in body)
+    return ''.join(parts)
+
+class EpubWriter:
+    """
+    Writes an EPUB 3 archive incrementally. Each chapter is converted to XHTML and
+    compressed into the zip as soon as it is added, so only file names and titles are
+    kept until finish() writes the package documents. add_chapter() may be called from
+    several threads at once; only the zip write itself is serialized.
+    """
+
+    def __init__(self, title: str, language: str = 'en', author: str = 'WebToEpub Bot',
+                 remove_images: bool = False, remove_hyperlinks: bool = False):
+        self.title = title
+        self.language = language
+        self.author = author
+        self.remove_images = remove_images
+        self.remove_hyperlinks = remove_hyperlinks
+        self._chapters = []
+        self._lock = threading.Lock()
+        self._buffer = io.BytesIO()
+        self._zip = zipfile.ZipFile(self._buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=6)
+        # Readers sniff the format from the first entry, which must be stored uncompressed.
+        self._zip.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self._zip.writestr('META-INF/container.xml', _CONTAINER_XML)
+
+    def _document(self, title: str, body: str) -> str:
+        return _XHTML_DOCUMENT.format(lang=self.language, title=escape(title), body=body)
+
+    def add_chapter(self, order: int, file_name: str, title: str, html: str):
+        """Writes one chapter; order decides its place in the spine and TOC, not the call order."""
+        document = self._document(title, _to_xhtml_body(html, self.remove_images, self.remove_hyperlinks))
+        with self._lock:
+            self._zip.writestr(f'EPUB/{file_name}', document)
+            self._chapters.append((order, file_name, title))
+
+    def finish(self) -> bytes:
+        """Writes the OPF, NCX and navigation documents, closes the archive and returns its bytes."""
+        with self._lock:
+            chapters = sorted(self._chapters)
+            identifier = escape('id' + self.title)
+            title = escape(self.title)
+            ids = [file_name.removesuffix('.xhtml') for _, file_name, _ in chapters]
+
+            nav_items = ''.join(
+                f'<li><a href="{escape(file_name)}">{escape(chapter_title)}</a></li>'
+                for _, file_name, chapter_title in chapters
+            )
+            nav_body = f'<nav epub:type="toc" id="id"><h2>{title}</h2><ol>{nav_items}</ol></nav>'
+            self._zip.writestr('EPUB/nav.xhtml', self._document(self.title, nav_body))
+
+            self._zip.writestr('EPUB/toc.ncx', _TOC_NCX.format(
+                identifier=identifier,
+                title=title,
+                nav_points='\n'.join(
+                    f'    <navPoint id="{escape(uid)}" playOrder="{n}"><navLabel><text>{escape(chapter_title)}</text></navLabel>'
+                    f'<content src="{escape(file_name)}"/></navPoint>'
+                    for n, (uid, (_, file_name, chapter_title)) in enumerate(zip(ids, chapters), start=1)
+                ),
+            ))
+
+            self._zip.writestr('EPUB/content.opf', _CONTENT_OPF.format(
+                identifier=identifier,
+                title=title,
+                lang=escape(self.language),
+                author=escape(self.author),
+                modified=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                items='\n'.join(
+                    f'    <item id="{escape(uid)}" href="{escape(file_name)}" media-type="application/xhtml+xml"/>'
+                    for uid, (_, file_name, _) in zip(ids, chapters)
+                ),
+                itemrefs='\n'.join(f'    <itemref idref="{escape(uid)}"/>' for uid in ids),
+            ))
+            self._zip.close()
+        return self._buffer.getvalue()
@@ -0,0 +1,18 @@
+"""JSON helpers that use orjson when it is installed and fall back to the stdlib."""
+import json
+
+# orjson.JSONDecodeError subclasses this, so callers can catch it with either backend.
+JSONDecodeError = json.JSONDecodeError
+
+try:
+    import orjson
+
+    def dumps(obj, indent: bool = False) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None).decode('utf-8')
+
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj, indent: bool = False) -> str:
+        return json.dumps(obj, indent=2 if indent else None)
+
+    loads = json.loads
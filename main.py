@@ -2,10 +2,12 @@ import logging
 import os
 import asyncio
 import re
-import json
-from telegram import Update
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.request import HTTPXRequest
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, filters,
+    AIORateLimiter, Application, CommandHandler, MessageHandler, filters,
     CallbackContext, CallbackQueryHandler, ConversationHandler
 )
 
@@ -13,8 +15,8 @@ from settings import (
     get_user_settings, handle_settings_callback,
     SETTING_VALUE, handle_setting_value_input, get_main_settings_menu
 )
-from parser import get_chapter_list, create_epub_from_chapters, load_parsers_from_json_content, ensure_parsers_are_loaded, generate_parsers_manifest
-from database import add_custom_parser, clean_database, set_log_channel, get_log_channel
+from parser import get_chapter_list, create_epub_from_chapters, load_parsers_from_json_content, ensure_parsers_are_loaded, generate_parsers_manifest, close_browser, clear_chapter_cache, log_to_channel
+from database import add_custom_parser, clean_database, set_log_channel
 
 # --- Enable logging ---
 logging.basicConfig(
@@ -25,21 +27,97 @@ logger = logging.getLogger(__name__)
 # --- Environment variables & Constants ---
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+# Optional. When set, Telegram sends it in a header on every webhook call and
+# updates without it are rejected before they reach any handler.
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+# Optional comma-separated Telegram user ids allowed to run /clearcache. Unset means nobody.
+ADMIN_USER_IDS = [int(uid) for uid in os.environ.get('ADMIN_USER_IDS', '').split(',') if uid.strip()]
+# Upper bound on parallel webhook deliveries Telegram will open to the bot.
+WEBHOOK_MAX_CONNECTIONS = 100
 PORT = int(os.environ.get('PORT', 8080))
+# Minimum gap between edits of a status message; updates in between are coalesced.
+STATUS_EDIT_INTERVAL = 0.8
+# Database calls run through asyncio.to_thread; size the pool so concurrent
+# updates can actually use the MongoDB connection pool instead of queueing.
+DB_EXECUTOR_WORKERS = 64
+
+_URL_RE = re.compile(r'https?://\S+')
 
 # --- Conversation states ---
 TARGET_URL, PARSER_FILE, LOAD_PARSER_FILE = range(3)
 CHAPTER_SELECTION = 0
 
 # --- Helper Functions ---
-async def log_to_channel(context: CallbackContext, message: str):
-    """Sends a log message to the configured log channel."""
-    log_channel_id = await asyncio.to_thread(get_log_channel)
-    if log_channel_id:
+class StatusMessage:
+    """
+    A single chat message that is edited in place as a job progresses.
+    Edits closer together than STATUS_EDIT_INTERVAL are coalesced into one.
+    """
+
+    def __init__(self, bot, chat_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message = None
+        self.text = None
+        self.last_edit_ts = 0.0
+        self.pending_text = None
+        self._flush_task = None
+
+    async def update(self, text: str):
+        self.pending_text = text
+        if self.message is None:
+            await self._flush()
+            return
+        if self._flush_task is not None:
+            return
+        delay = self.last_edit_ts + STATUS_EDIT_INTERVAL - time.monotonic()
+        if delay <= 0:
+            await self._flush()
+        else:
+            self._flush_task = asyncio.create_task(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self._flush_task = None
+        await self._flush()
+
+    async def _flush(self):
+        text, self.pending_text = self.pending_text, None
+        if text is None or text == self.text:
+            return
+        self.text = text
+        self.last_edit_ts = time.monotonic()
         try:
-            await context.bot.send_message(chat_id=log_channel_id, text=message)
+            if self.message is None:
+                self.message = await self.bot.send_message(self.chat_id, text)
+            else:
+                await self.message.edit_text(text)
         except Exception as e:
-            logger.error(f"Failed to send log to channel {log_channel_id}: {e}")
+            logger.error(f"Failed to update status message in chat {self.chat_id}: {e}")
+
+async def notify(context: CallbackContext, chat_id: int, message: str, log_message: str = None, final: bool = False):
+    """
+    Shows a status update to the user and sends it to the log channel concurrently.
+    Within an /epub job a progress update edits the job's status message instead of sending
+    a new one. Pass final=True for outcomes such as failures: edits don't notify the user,
+    so those always go out as a new message.
+    """
+    status = None if final else context.user_data.get('status')
+    user_update = status.update(message) if status else context.bot.send_message(chat_id, message)
+    await asyncio.gather(
+        user_update,
+        log_to_channel(context, log_message or message),
+        return_exceptions=True
+    )
+
+async def download_document(context: CallbackContext, document, encoding: str = None):
+    """
+    Downloads an uploaded document into memory.
+    Returns text when an encoding is given, otherwise the raw bytearray.
+    """
+    file = await context.bot.get_file(document.file_id)
+    data = await file.download_as_bytearray()
+    return data.decode(encoding) if encoding else data
 
 # --- Command Handlers ---
 
@@ -56,6 +134,7 @@ async def start(update: Update, context: CallbackContext) -> None:
         '/settings - Configure options.\n'
         '/add_parser - Add a custom parser.\n'
         '/cleandb - (Admin) Wipes the entire database.\n'
+        '/clearcache - (Admin) Clears cached chapter content.\n'
         '/logc - (Admin) Sets the channel for detailed logs.\n'
         '/loadparsers - (Admin) Load parsers into the database from a `parsers.json` file.\n'
         '/parserjson - (Admin) Generate the `parsers.json` file from your local parsers.'
@@ -76,6 +155,16 @@ async def clean_db_command(update: Update, context: CallbackContext) -> None:
         logger.error(f"Error cleaning database: {e}", exc_info=True)
         await update.message.reply_text("An error occurred while cleaning the database.")
 
+async def clear_cache_command(update: Update, context: CallbackContext) -> None:
+    """Clears the on-disk chapter cache."""
+    try:
+        removed = await asyncio.to_thread(clear_chapter_cache)
+        await update.message.reply_text(f"Cleared {removed} cached chapters.")
+        await log_to_channel(context, f"Chapter cache cleared by user {update.effective_user.id}.")
+    except Exception as e:
+        logger.error(f"Error clearing chapter cache: {e}", exc_info=True)
+        await update.message.reply_text("An error occurred while clearing the cache.")
+
 async def set_log_channel_command(update: Update, context: CallbackContext) -> None:
     """Sets the log channel ID."""
     if not context.args:
@@ -115,8 +204,8 @@ async def received_parsers_file(update: Update, context: CallbackContext) -> int
         return LOAD_PARSER_FILE
 
     try:
-        file = await context.bot.get_file(update.message.document.file_id)
-        parsers_content = (await file.download_as_bytearray()).decode('utf-8')
+        # Left as bytes; the JSON loader decodes UTF-8 itself.
+        parsers_content = await download_document(context, update.message.document)
         
         sent_message = await update.message.reply_text("Processing `parsers.json` and loading into the database... This may take a moment.")
         
@@ -148,8 +237,7 @@ async def received_parser_file(update: Update, context: CallbackContext) -> int:
         return PARSER_FILE
 
     try:
-        file = await context.bot.get_file(update.message.document.file_id)
-        parser_content = (await file.download_as_bytearray()).decode('utf-8')
+        parser_content = await download_document(context, update.message.document, encoding='utf-8')
         await asyncio.to_thread(add_custom_parser, user_id, target_url, parser_content)
         await update.message.reply_text(f"Custom parser for {target_url} has been added successfully!")
     except Exception as e:
@@ -166,84 +254,145 @@ async def cancel(update: Update, context: CallbackContext) -> int:
     return ConversationHandler.END
 
 # --- Chapter Selection and EPUB Creation ---
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+CHAPTER_PAGE_SIZE = 10
+CHAPTER_BUTTON_TITLE_LENGTH = 60
+
+# Indexed by the selection byte (0 or 1).
+_CHK = ("❌", "✅")
+
+def chapter_button(button_title, index, selected):
+    return InlineKeyboardButton(f"{_CHK[selected]} {button_title}", callback_data=f"t{index}")
 
-async def build_chapter_selection_keyboard(chapters, page=0, page_size=10):
+async def build_chapter_selection_keyboard(button_titles, selected, page=0, page_size=CHAPTER_PAGE_SIZE):
+    # Callback data uses one-letter opcodes: t<index>, p<page>, sA/sD and D (done).
     keyboard = []
     start_index = page * page_size
     end_index = start_index + page_size
     
-    for i, chapter in enumerate(chapters[start_index:end_index]):
-        status_emoji = "✅" if chapter.get('selected', True) else "❌"
-        keyboard.append([InlineKeyboardButton(f"{status_emoji} {chapter['title']}", callback_data=f"toggle_chapter_{start_index + i}")])
+    for i, button_title in enumerate(button_titles[start_index:end_index]):
+        keyboard.append([chapter_button(button_title, start_index + i, selected[start_index + i])])
     nav_row = []
     if page > 0:
-        nav_row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"page_{page-1}"))
-    if end_index < len(chapters):
-        nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"page_{page+1}"))
+        nav_row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"p{page-1}"))
+    if end_index < len(button_titles):
+        nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"p{page+1}"))
     if nav_row: keyboard.append(nav_row)
     keyboard.append([
-        InlineKeyboardButton("Select All", callback_data="select_all"),
-        InlineKeyboardButton("Deselect All", callback_data="deselect_all")
+        InlineKeyboardButton("Select All", callback_data="sA"),
+        InlineKeyboardButton("Deselect All", callback_data="sD")
     ])
-    keyboard.append([InlineKeyboardButton("Done ✅", callback_data="done_selecting")])
+    keyboard.append([InlineKeyboardButton("Done ✅", callback_data="D")])
     return InlineKeyboardMarkup(keyboard)
 
 async def display_chapter_selection(update: Update, context: CallbackContext, message_text: str):
-    chapters = context.user_data['chapters']
     page = context.user_data.get('page', 0)
-    reply_markup = await build_chapter_selection_keyboard(chapters, page)
+    reply_markup = await build_chapter_selection_keyboard(context.user_data['button_titles'], context.user_data['selected'], page)
+    # Keep the rows so a single toggle can patch its button instead of rebuilding the page.
+    context.user_data['_kb'] = [list(row) for row in reply_markup.inline_keyboard]
     if update.callback_query:
         await update.callback_query.edit_message_text(text=message_text, reply_markup=reply_markup)
     else:
         await update.message.reply_text(text=message_text, reply_markup=reply_markup)
 
+async def redisplay_chapter_selection(update: Update, context: CallbackContext):
+    await display_chapter_selection(update, context, f"Select chapters for: {context.user_data['title']}")
+
+async def toggle_chapter(update: Update, context: CallbackContext, arg: str):
+    # One byte per chapter instead of a 'selected' key on every chapter dict.
+    selected = context.user_data['selected']
+    button_titles = context.user_data['button_titles']
+    index = int(arg)
+    if not 0 <= index < len(selected):
+        # A tap left over from an earlier, longer chapter list.
+        await redisplay_chapter_selection(update, context)
+        return
+    selected[index] ^= 1
+    keyboard = context.user_data.get('_kb')
+    first_on_page = context.user_data.get('page', 0) * CHAPTER_PAGE_SIZE
+    row = index - first_on_page
+    # Only the leading rows are chapter buttons; a stale tap from another page must not patch nav or Done.
+    chapter_rows = min(CHAPTER_PAGE_SIZE, len(button_titles) - first_on_page)
+    if keyboard and 0 <= row < chapter_rows:
+        keyboard[row][0] = chapter_button(button_titles[index], index, selected[index])
+        await update.callback_query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        await redisplay_chapter_selection(update, context)
+
+async def change_chapter_page(update: Update, context: CallbackContext, arg: str):
+    context.user_data['page'] = int(arg)
+    await redisplay_chapter_selection(update, context)
+
+async def select_all_chapters(update: Update, context: CallbackContext, arg: str):
+    selected = context.user_data['selected']
+    selected[:] = (b'\x01' if arg == 'A' else b'\x00') * len(selected)
+    await redisplay_chapter_selection(update, context)
+
+def selected_chapter_list(user_data) -> list:
+    # Chapter dicts are only rebuilt here, for the chapters that are actually being fetched.
+    return [
+        {'title': t, 'url': u}
+        for t, u, is_selected in zip(user_data['titles'], user_data['urls'], user_data['selected']) if is_selected
+    ]
+
+async def finish_chapter_selection(update: Update, context: CallbackContext, selected_chapters: list):
+    query = update.callback_query
+    await query.edit_message_text("Processing selected chapters...")
+    if not selected_chapters:
+        await query.message.reply_text("No chapters selected.")
+        return ConversationHandler.END
+    await process_chapters_to_epub(update, context, selected_chapters)
+    return ConversationHandler.END
+
+CHAPTER_SELECTION_ACTIONS = {
+    't': toggle_chapter,
+    'p': change_chapter_page,
+    's': select_all_chapters,
+}
+
 async def chapter_selection_callback(update: Update, context: CallbackContext):
+    # Runs non-blocking, so taps from the same user can overlap.
     query = update.callback_query
     await query.answer()
-    action, _, data = query.data.partition('_')
-    chapters = context.user_data.get('chapters', [])
-    if action == 'toggle':
-        chapters[int(data)]['selected'] = not chapters[int(data)].get('selected', True)
-    elif action == 'page':
-        context.user_data['page'] = int(data)
-    elif action == 'select':
-        for chapter in chapters: chapter['selected'] = (data == 'all')
-    
-    if action == 'done':
-        await query.edit_message_text("Processing selected chapters...")
-        selected_chapters = [ch for ch in chapters if ch.get('selected', True)]
-        if not selected_chapters:
-            await query.message.reply_text("No chapters selected.")
-            return ConversationHandler.END
-        await process_chapters_to_epub(update, context, selected_chapters)
-        return ConversationHandler.END
-    else:
-        await display_chapter_selection(update, context, f"Select chapters for: {context.user_data['title']}")
+    user_data = context.user_data
+    # The conversation stays in CHAPTER_SELECTION while the EPUB is built; ignore taps until it is done.
+    if user_data.get('building'):
+        return None
+    # Taps are applied one at a time and in tap order: each edit sends a whole keyboard
+    # snapshot, and Done must see every toggle tapped before it.
+    lock = user_data.setdefault('_kb_lock', asyncio.Lock())
+    if query.data == 'D':
+        async with lock:
+            if user_data.get('building'):
+                return None
+            user_data['building'] = True
+            selected_chapters = selected_chapter_list(user_data)
+        try:
+            return await finish_chapter_selection(update, context, selected_chapters)
+        finally:
+            user_data.pop('building', None)
+    async with lock:
+        # Taps queued behind Done must not touch the selection or re-attach the keyboard.
+        if user_data.get('building'):
+            return None
+        return await CHAPTER_SELECTION_ACTIONS[query.data[0]](update, context, query.data[1:])
 
 
 async def process_chapters_to_epub(update: Update, context: CallbackContext, chapters: list):
     chat_id = update.effective_chat.id
     title = context.user_data.get('title', 'Untitled')
-    message = f"Creating EPUB for '{title}'..."
-    await context.bot.send_message(chat_id, message)
-    await log_to_channel(context, message)
+    await notify(context, chat_id, f"Creating EPUB for '{title}'...")
     
     try:
         user_settings = await asyncio.to_thread(get_user_settings, update.effective_user.id)
-        epub_path, final_filename = await create_epub_from_chapters(chapters, title, user_settings)
-        if epub_path and os.path.exists(epub_path):
-            with open(epub_path, 'rb') as epub_file:
-                await context.bot.send_document(chat_id=chat_id, document=epub_file, filename=f"{final_filename}.epub", caption=f"EPUB for: {title}")
-            os.remove(epub_path)
+        epub_bytes, final_filename = await create_epub_from_chapters(chapters, title, user_settings, update.effective_user.id)
+        if epub_bytes:
+            await context.bot.send_document(chat_id=chat_id, document=epub_bytes, filename=f"{final_filename}.epub", caption=f"EPUB for: {title}")
             await log_to_channel(context, f"Successfully created and sent EPUB for '{title}'.")
         else:
-            await context.bot.send_message(chat_id, f"Failed to create EPUB for: {title}")
-            await log_to_channel(context, f"Failed to create EPUB for '{title}'.")
+            await notify(context, chat_id, f"Failed to create EPUB for: {title}", f"Failed to create EPUB for '{title}'.", final=True)
     except Exception as e:
         logger.error(f"Error creating EPUB: {e}", exc_info=True)
-        await context.bot.send_message(chat_id, f"An error occurred: {e}")
-        await log_to_channel(context, f"Error creating EPUB for '{title}': {e}")
+        await notify(context, chat_id, f"An error occurred: {e}", f"Error creating EPUB for '{title}': {e}", final=True)
 
 async def epub_command(update: Update, context: CallbackContext) -> int:
     try:
@@ -256,19 +405,29 @@ async def epub_command(update: Update, context: CallbackContext) -> int:
     url = ""
     if context.args: url = context.args[0]
     elif update.message.reply_to_message and update.message.reply_to_message.text:
-        urls = re.findall(r'http[s]?://\S+', update.message.reply_to_message.text)
-        if urls: url = urls[0]
+        # Only the first link is used, so stop scanning at the first match.
+        match = _URL_RE.search(update.message.reply_to_message.text)
+        if match: url = match.group()
     if not url:
         await update.message.reply_text("Usage: /epub <URL> or reply to a message with a link.")
         return ConversationHandler.END
     
-    await update.message.reply_text(f"Fetching chapters from: {url}")
-    await log_to_channel(context, f"Received /epub command for: {url}")
+    context.user_data['status'] = StatusMessage(context.bot, update.effective_chat.id)
+    await notify(context, update.effective_chat.id, f"Fetching chapters from: {url}", f"Received /epub command for: {url}")
     
     try:
         title, chapters, parser_found = await get_chapter_list(url, update.effective_user.id, context)
         if not chapters: raise ValueError("No chapters found.")
-        context.user_data.update({'chapters': chapters, 'title': title, 'page': 0})
+        # Parallel lists rather than a list of dicts; far smaller while a selection is open.
+        context.user_data.update({
+            'titles': [c['title'] for c in chapters],
+            'urls': [c['url'] for c in chapters],
+            'selected': bytearray(b'\x01' * len(chapters)),
+            # Button labels are truncated once here rather than on every re-render.
+            'button_titles': [c['title'][:CHAPTER_BUTTON_TITLE_LENGTH] for c in chapters],
+            'title': title,
+            'page': 0
+        })
         
         if len(chapters) == 1 and not parser_found:
             await process_chapters_to_epub(update, context, chapters)
@@ -283,8 +442,7 @@ async def epub_command(update: Update, context: CallbackContext) -> int:
         return CHAPTER_SELECTION
     except Exception as e:
         logger.error(f"Failed to get chapters: {e}", exc_info=True)
-        await update.message.reply_text(f"Could not fetch chapters. Error: {e}")
-        await log_to_channel(context, f"Failed to get chapters for {url}. Error: {e}")
+        await notify(context, update.effective_chat.id, f"Could not fetch chapters. Error: {e}", f"Failed to get chapters for {url}. Error: {e}", final=True)
         return ConversationHandler.END
 
 async def handle_default_parser_choice(update: Update, context: CallbackContext) -> int:
@@ -299,42 +457,87 @@ async def handle_default_parser_choice(update: Update, context: CallbackContext)
         return ConversationHandler.END
 
 # --- Main Application Setup ---
+# Handlers and filters shared by the conversation handlers below.
+_CANCEL_FALLBACKS = [CommandHandler('cancel', cancel)]
+_TEXT_NOCMD = filters.TEXT & ~filters.COMMAND
+_JS_FILTER = filters.Document.FileExtension("js")
+_JSON_FILTER = filters.Document.FileExtension("json")
+
+async def post_init(application: Application) -> None:
+    """Runs once the event loop is up, before the bot starts taking updates."""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+    )
+
+async def post_shutdown(application: Application) -> None:
+    """Releases the shared Chromium instance when the bot stops."""
+    await close_browser()
+
 def main() -> None:
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    if not TELEGRAM_BOT_TOKEN or not WEBHOOK_URL:
+        logger.critical("TELEGRAM_BOT_TOKEN and WEBHOOK_URL must both be set.")
+        return
+
+    # uvloop is a faster drop-in event loop; fall back to asyncio's own where it isn't available.
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        logger.info("uvloop not installed; using the default asyncio event loop.")
+
+    # A larger keep-alive pool over HTTP/2 so bursts of Bot API calls reuse connections.
+    bot_request = HTTPXRequest(connection_pool_size=64, connect_timeout=5.0, read_timeout=30.0, http_version="2")
+    # Queue outbound calls within Telegram's flood limits instead of running into 429s.
+    rate_limiter = AIORateLimiter(overall_max_rate=30, overall_time_period=1, group_max_rate=20, group_time_period=60, max_retries=3)
+    application = (
+        Application.builder().token(TELEGRAM_BOT_TOKEN)
+        .request(bot_request).rate_limiter(rate_limiter)
+        .post_init(post_init).post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("settings", settings_command))
     application.add_handler(CommandHandler("parserjson", generate_manifest_command))
     application.add_handler(CommandHandler("cleandb", clean_db_command))
+    # The chapter cache is shared by every user, so only admins may wipe it.
+    application.add_handler(CommandHandler("clearcache", clear_cache_command, filters=filters.User(user_id=ADMIN_USER_IDS)))
     application.add_handler(CommandHandler("logc", set_log_channel_command))
     
     # Conversation handlers
     application.add_handler(ConversationHandler(
         entry_points=[CommandHandler('loadparsers', load_parsers_start)],
-        states={LOAD_PARSER_FILE: [MessageHandler(filters.Document.FileExtension("json"), received_parsers_file)]},
-        fallbacks=[CommandHandler('cancel', cancel)]
+        states={LOAD_PARSER_FILE: [MessageHandler(_JSON_FILTER, received_parsers_file)]},
+        fallbacks=_CANCEL_FALLBACKS
     ))
     application.add_handler(ConversationHandler(
         entry_points=[CommandHandler('epub', epub_command)],
-        states={CHAPTER_SELECTION: [CallbackQueryHandler(chapter_selection_callback, pattern='^(toggle|page|select|done)'), CallbackQueryHandler(handle_default_parser_choice, pattern='^dp_')]},
-        fallbacks=[CommandHandler('cancel', cancel)]
+        # Button taps run as tasks so a burst of them isn't processed strictly one after another.
+        states={CHAPTER_SELECTION: [
+            CallbackQueryHandler(chapter_selection_callback, pattern=r'^(t\d+|p\d+|s[AD]|D)$', block=False),
+            CallbackQueryHandler(handle_default_parser_choice, pattern='^dp_', block=False)
+        ]},
+        fallbacks=_CANCEL_FALLBACKS
     ))
     application.add_handler(ConversationHandler(
         entry_points=[CommandHandler('add_parser', add_parser_start)],
-        states={TARGET_URL: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_target_url)], PARSER_FILE: [MessageHandler(filters.Document.FileExtension("js"), received_parser_file)]},
-        fallbacks=[CommandHandler('cancel', cancel)]
+        states={TARGET_URL: [MessageHandler(_TEXT_NOCMD, received_target_url)], PARSER_FILE: [MessageHandler(_JS_FILTER, received_parser_file)]},
+        fallbacks=_CANCEL_FALLBACKS
     ))
     application.add_handler(ConversationHandler(
         entry_points=[CallbackQueryHandler(handle_settings_callback, pattern='^set_')],
-        states={SETTING_VALUE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_setting_value_input)]},
-        fallbacks=[CommandHandler('cancel', cancel)],
+        states={SETTING_VALUE: [MessageHandler(_TEXT_NOCMD, handle_setting_value_input)]},
+        fallbacks=_CANCEL_FALLBACKS,
         map_to_parent={ConversationHandler.END: ConversationHandler.END}
     ))
     application.add_handler(CallbackQueryHandler(handle_settings_callback, pattern='^(toggle_|goto_|back_to_)'))
     
     # Run the bot
-    application.run_webhook(listen="0.0.0.0", port=PORT, url_path=TELEGRAM_BOT_TOKEN, webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_BOT_TOKEN}")
+    application.run_webhook(
+        listen="0.0.0.0", port=PORT, url_path=TELEGRAM_BOT_TOKEN, webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_BOT_TOKEN}",
+        max_connections=WEBHOOK_MAX_CONNECTIONS, secret_token=WEBHOOK_SECRET
+    )
 
 if __name__ == '__main__':
     main()
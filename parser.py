@@ -1,13 +1,18 @@
 import asyncio
+import contextlib
+import functools
+import hashlib
 import os
 import re
-from ebooklib import epub
-from bs4 import BeautifulSoup
+from pathlib import Path
+from selectolax.parser import HTMLParser
+import diskcache
 from playwright.async_api import async_playwright
-from database import get_custom_parser, get_repo_parser, save_parsers_from_repo, clean_all_parsers, get_parser_count
-from urllib.parse import urljoin, quote, urlparse
+from database import resolve_parser, save_parsers_from_repo, get_parser_count
+from urllib.parse import urljoin, urlparse
 import logging
-import json
+import fastjson
+from epub_writer import EpubWriter
 from telegram.ext import CallbackContext
 
 # Enhanced logging to capture every detail
@@ -19,30 +24,181 @@ logger = logging.getLogger(__name__)
 
 CHROME_EXECUTABLE_PATH = "/opt/render/project/.render/chrome/opt/google/chrome/google-chrome"
 REPO_DIR = "webtoepub_lib" 
+PLUGIN_DIR = os.path.abspath(os.path.join(REPO_DIR, "plugin"))
+JS_DIR = os.path.join(PLUGIN_DIR, "js")
+PARSERS_DIR = os.path.join(JS_DIR, "parsers")
+UNITTEST_DIR = os.path.abspath(os.path.join(REPO_DIR, "unitTest"))
+
+# Link text that looks like a chapter, for the generic scraping fallback.
+_CHAPTER_RE = re.compile(r'chapter|ep\d+|ch\.\d+', re.I)
+# Characters that are not allowed in the EPUB's file name.
+_UNSAFE_FILENAME_CHARS = str.maketrans('', '', '\\/*?:"<>|')
 
 # A global flag to ensure we only check the DB once per session
 PARSERS_LOADED = False
 
+# --- Chapter cache ---
+# Extracted chapter HTML on local disk, so re-running /epub on a book skips pages already fetched.
+CHAPTER_CACHE_DIR = os.environ.get('CHAPTER_CACHE_DIR', '/tmp/wte_cache')
+CHAPTER_CACHE_TTL = 86400
+_chapter_cache = diskcache.Cache(CHAPTER_CACHE_DIR, size_limit=2 << 30)
+
+def clear_chapter_cache() -> int:
+    """Empties the chapter cache and returns the number of entries removed."""
+    return _chapter_cache.clear()
+
+# --- Shared browser ---
+# One Chromium process for the whole bot; each job gets its own context for isolation.
+BROWSER_ARGS = ['--no-sandbox', '--disable-setuid-sandbox', '--disable-dev-shm-usage']
+_playwright = None
+_browser = None
+_browser_lock = asyncio.Lock()
+# Chapter pages loaded at the same time while building one EPUB.
+CHAPTER_FETCH_CONCURRENCY = 5
+# CDP resource types that scraping never needs. Chapter pages keep images in case a parser inspects them.
+BLOCKED_RESOURCE_TYPES = ("Image", "Media", "Font", "Stylesheet")
+CHAPTER_BLOCKED_RESOURCE_TYPES = ("Media", "Font", "Stylesheet")
+# Pages evaluating parser files in parallel during /parserjson.
+MANIFEST_SCAN_WORKERS = 8
+# Browser contexts kept open for chapter fetching and shared by all jobs.
+CHAPTER_CONTEXT_POOL_SIZE = 16
+_chapter_contexts = None
+
+_CHROME_FOUND = False
+
+def _chrome_executable_exists() -> bool:
+    """Checks for the Chrome executable, remembering a positive result for the process lifetime."""
+    global _CHROME_FOUND
+    if not _CHROME_FOUND:
+        _CHROME_FOUND = os.path.exists(CHROME_EXECUTABLE_PATH)
+    return _CHROME_FOUND
+
+async def get_browser():
+    """Returns the shared browser, launching it on first use or after it has crashed."""
+    global _playwright, _browser
+    async with _browser_lock:
+        if _browser is None or not _browser.is_connected():
+            if _playwright is None:
+                _playwright = await async_playwright().start()
+            _browser = await _playwright.chromium.launch(executable_path=CHROME_EXECUTABLE_PATH, args=BROWSER_ARGS)
+            logger.info("Launched shared Chromium instance.")
+        return _browser
+
+async def new_browser_context(parser_script: str = None):
+    """
+    Opens an isolated context on the shared browser. Open its pages with new_page().
+    The parser dependency scripts are registered as init scripts, so every page in it starts with them loaded.
+    When a parser script is given it is compiled into every page as well; see PARSER_INIT_JS.
+    """
+    browser = await get_browser()
+    browser_context = await browser.new_context()
+    dependency_bundle = await asyncio.to_thread(_dependency_bundle)
+    if not dependency_bundle:
+        # Parsers then report that none was registered, and callers fall back to generic scraping.
+        logger.error("Could not load dependency scripts for parser execution.")
+        return browser_context
+    await browser_context.add_init_script(script=dependency_bundle)
+    if parser_script is not None:
+        await browser_context.add_init_script(script=PARSER_INIT_JS % fastjson.dumps(parser_script))
+    return browser_context
+
+async def new_page(browser_context, blocked_resource_types=BLOCKED_RESOURCE_TYPES):
+    """
+    Opens a page on which requests of the given resource types are refused. Chromium only
+    pauses requests of those types, so documents, scripts and XHR/fetch never leave the
+    browser, and unlike context.route() the HTTP cache stays on.
+    """
+    page = await browser_context.new_page()
+    cdp = await browser_context.new_cdp_session(page)
+
+    async def fail_request(event):
+        try:
+            await cdp.send("Fetch.failRequest", {"requestId": event["requestId"], "errorReason": "BlockedByClient"})
+        except Exception:
+            pass  # The page was closed while the request was paused.
+
+    cdp.on("Fetch.requestPaused", fail_request)
+    await cdp.send("Fetch.enable", {"patterns": [
+        {"urlPattern": "*", "resourceType": resource_type, "requestStage": "Request"}
+        for resource_type in blocked_resource_types
+    ]})
+    return page
+
+@contextlib.asynccontextmanager
+async def borrow_chapter_context(parser: dict = None):
+    """
+    Lends a context from the chapter pool, waiting while all of them are in use.
+    Each context has one parser (or none) compiled in; a slot holding a different
+    parser, or one from before a browser relaunch, is replaced with a fresh context.
+    """
+    global _chapter_contexts
+    if _chapter_contexts is None:
+        _chapter_contexts = asyncio.Queue()
+        for _ in range(CHAPTER_CONTEXT_POOL_SIZE):
+            _chapter_contexts.put_nowait((None, None))
+    # Custom parsers share a filename across users, so the script itself is part of the key.
+    wanted_key = (parser['filename'], hash(parser['script'])) if parser else None
+    parser_key, browser_context = await _chapter_contexts.get()
+    try:
+        if browser_context is None or parser_key != wanted_key or not browser_context.browser.is_connected():
+            stale, browser_context, parser_key = browser_context, None, None
+            if stale is not None and stale.browser.is_connected():
+                await stale.close()
+            browser_context = await new_browser_context(parser and parser['script'])
+            parser_key = wanted_key
+        yield browser_context
+    finally:
+        _chapter_contexts.put_nowait((parser_key, browser_context))
+
+async def close_browser():
+    """Closes the shared browser and stops Playwright. Called on application shutdown."""
+    global _playwright, _browser, _chapter_contexts
+    _chapter_contexts = None
+    async with _browser_lock:
+        if _browser is not None:
+            try:
+                await _browser.close()
+            except Exception as e:
+                logger.error(f"Failed to close shared browser: {e}")
+            _browser = None
+        if _playwright is not None:
+            await _playwright.stop()
+            _playwright = None
+
+# --- Log channel ---
+# The rate limiter caps the log channel at group speed (20 messages a minute), so log
+# messages are sent in the background and never hold up the handler that logged them.
+# Past LOG_BACKLOG_LIMIT queued sends, new messages are dropped rather than piling up.
+LOG_BACKLOG_LIMIT = 100
+_log_tasks = set()
+
+async def _send_log(bot, log_channel_id, message: str):
+    try:
+        await bot.send_message(chat_id=log_channel_id, text=message)
+    except Exception as e:
+        logger.error(f"Failed to send log to channel {log_channel_id}: {e}")
+
 async def log_to_channel(context: CallbackContext, message: str):
-    """Sends a log message to the configured log channel."""
+    """Queues a log message for the configured log channel without waiting for it to be sent."""
     from database import get_log_channel
     log_channel_id = await asyncio.to_thread(get_log_channel)
-    if log_channel_id:
-        try:
-            await context.bot.send_message(chat_id=log_channel_id, text=message)
-        except Exception as e:
-            logger.error(f"Failed to send log to channel {log_channel_id}: {e}")
+    if not log_channel_id:
+        return
+    if len(_log_tasks) >= LOG_BACKLOG_LIMIT:
+        logger.warning(f"Log channel backlog full; dropped log message: {message}")
+        return
+    task = asyncio.create_task(_send_log(context.bot, log_channel_id, message))
+    _log_tasks.add(task)
+    task.add_done_callback(_log_tasks.discard)
 
+@functools.lru_cache(maxsize=1)
 def _load_dependency_scripts():
-    js_dir = os.path.abspath(os.path.join(REPO_DIR, "plugin", "js"))
-    plugin_dir = os.path.abspath(os.path.join(REPO_DIR, "plugin"))
-    unittest_dir = os.path.abspath(os.path.join(REPO_DIR, "unitTest"))
-
+    """Reads the WebToEpub library scripts parsers depend on. They never change at runtime, so this runs once."""
     dependency_map = {
-        "_locales/en/messages.json": plugin_dir, "polyfillChrome.js": unittest_dir,
-        "EpubItem.js": js_dir, "DebugUtil.js": js_dir, "HttpClient.js": js_dir,
-        "ImageCollector.js": js_dir, "Imgur.js": js_dir, "Parser.js": js_dir,
-        "ParserFactory.js": js_dir, "UserPreferences.js": js_dir, "Util.js": js_dir,
+        "_locales/en/messages.json": PLUGIN_DIR, "polyfillChrome.js": UNITTEST_DIR,
+        "EpubItem.js": JS_DIR, "DebugUtil.js": JS_DIR, "HttpClient.js": JS_DIR,
+        "ImageCollector.js": JS_DIR, "Imgur.js": JS_DIR, "Parser.js": JS_DIR,
+        "ParserFactory.js": JS_DIR, "UserPreferences.js": JS_DIR, "Util.js": JS_DIR,
     }
 
     scripts = []
@@ -55,8 +211,61 @@ def _load_dependency_scripts():
                 scripts.append(script_content)
         except FileNotFoundError:
             logger.error(f"FATAL: A required library file was not found: {filepath}")
-            return []
-    return scripts
+            return ()
+    return tuple(scripts)
+
+# Evaluates one parser script and returns the domains it registers with parserFactory.
+REGISTERED_DOMAINS_JS = """
+    (parserScript) => {
+        const registeredDomains = [];
+        parserFactory.register = (domains, parser) => {
+            if (typeof domains === 'string') { registeredDomains.push(domains); }
+            else if (Array.isArray(domains)) { registeredDomains.push(...domains); }
+        };
+        // Like a failing <script> tag: keep whatever was registered before the error.
+        try { eval(parserScript); } catch (e) {}
+        return registeredDomains;
+    }
+"""
+
+# Init script wrapping the dependency scripts. It runs at document start in every frame,
+# so the library lives in a function scope: its classes and globals (util, parserFactory,
+# chrome, ...) can't clash with the site's own top-level declarations. The only thing
+# exposed is __wteCompileParser, which evals a parser inside that scope and returns the
+# constructor it registers. A compile error is kept in __wteParserError for error reports.
+DEPENDENCY_BUNDLE_JS = """
+(() => {
+    if (window.top !== window) { return; }
+%s
+    window.__wteCompileParser = (parserScript) => {
+        let ctor = null;
+        const register = parserFactory.register;
+        parserFactory.register = (domains, parser) => { ctor = parser; };
+        window.__wteParserError = null;
+        try { eval(parserScript); }
+        catch (e) { window.__wteParserError = e.toString(); }
+        finally { parserFactory.register = register; }
+        return ctor;
+    };
+})();
+"""
+
+# Init script that compiles a parser once per page and keeps its constructor for
+# run_parser_in_browser, so the source isn't sent and eval'd again for every chapter.
+PARSER_INIT_JS = """
+    if (window.__wteCompileParser) { window.__wteParserCtor = window.__wteCompileParser(%s); }
+"""
+
+@functools.lru_cache(maxsize=1)
+def _dependency_bundle():
+    """The dependency scripts as one scoped init script (see DEPENDENCY_BUNDLE_JS), or '' if they are missing."""
+    scripts = _load_dependency_scripts()
+    return DEPENDENCY_BUNDLE_JS % "\n;\n".join(scripts) if scripts else ''
+
+@functools.lru_cache(maxsize=1)
+def _dependency_script_tags():
+    """The dependency scripts as one string of inline <script> tags."""
+    return "".join(f"<script>{s}</script>" for s in _load_dependency_scripts())
 
 async def generate_parsers_manifest(sent_message):
     """
@@ -65,44 +274,42 @@ async def generate_parsers_manifest(sent_message):
     """
     await sent_message.edit_text("Starting parser scan... This is a one-time process and will take several minutes.")
     
-    parsers_dir = os.path.abspath(os.path.join(REPO_DIR, "plugin", "js", "parsers"))
+    parsers_dir = PARSERS_DIR
     manifest_path = 'parsers.json'
     
     if not os.path.isdir(parsers_dir):
         await sent_message.edit_text(f"❌ ERROR: Parsers directory not found at {parsers_dir}.")
         return
 
-    dependency_scripts_list = _load_dependency_scripts()
+    dependency_scripts_list = await asyncio.to_thread(_load_dependency_scripts)
     if not dependency_scripts_list:
         await sent_message.edit_text("❌ ERROR: Could not load base dependency scripts. Aborting.")
         return
         
-    parser_files = [f for f in os.listdir(parsers_dir) if f.endswith('.js') and f != 'Template.js']
+    parser_files = [f for f in await asyncio.to_thread(os.listdir, parsers_dir) if f.endswith('.js') and f != 'Template.js']
     total_files = len(parser_files)
     logger.info(f"Found {total_files} local parser files to process for manifest.")
     
     manifest_data = {}
     processed_count = 0
-    
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(executable_path=CHROME_EXECUTABLE_PATH, args=['--no-sandbox'])
-        page = await browser.new_page()
-
-        for filename in parser_files:
-            processed_count += 1
-            if processed_count % 10 == 0:
-                await sent_message.edit_text(f"Scanning parsers... ({processed_count}/{total_files})")
-            
+    progress_step = max(1, total_files // 10)
+    queue = asyncio.Queue()
+    for filename in parser_files:
+        queue.put_nowait(filename)
+
+    async def scan_worker(browser_context):
+        nonlocal processed_count
+        page = await browser_context.new_page()
+        # Load the dependencies once; each parser is then evaluated in its own scope on the same page.
+        await page.set_content(f"<!DOCTYPE html><html><body>{_dependency_script_tags()}</body></html>", timeout=15000, wait_until='domcontentloaded')
+
+        while not queue.empty():
+            filename = queue.get_nowait()
             try:
                 filepath = os.path.join(parsers_dir, filename)
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    parser_script = f.read()
+                parser_script = await asyncio.to_thread(Path(filepath).read_text, encoding='utf-8')
 
-                script_tags = "".join([f"<script>{s}</script>" for s in dependency_scripts_list])
-                html_content = f"<!DOCTYPE html><html><body>{script_tags}<script>var registeredDomains = []; parserFactory.register = (domains, parser) => {{ if (typeof domains === 'string') {{ registeredDomains.push(domains); }} else if (Array.isArray(domains)) {{ registeredDomains.push(...domains); }} }};</script><script>{parser_script}</script></body></html>"
-                data_url = f"data:text/html,{quote(html_content)}"
-                await page.goto(data_url, timeout=15000, wait_until='domcontentloaded')
-                domains = await page.evaluate("() => window.registeredDomains")
+                domains = await page.evaluate(REGISTERED_DOMAINS_JS, parser_script)
 
                 if isinstance(domains, list) and domains:
                     manifest_data[filename] = domains
@@ -112,55 +319,70 @@ async def generate_parsers_manifest(sent_message):
 
             except Exception as e:
                 logger.error(f"Failed to process local parser {filename} for manifest: {e}", exc_info=False)
-        
-        await browser.close()
+
+            processed_count += 1
+            if processed_count % progress_step == 0:
+                await sent_message.edit_text(f"Scanning parsers... ({processed_count}/{total_files})")
+
+    browser = await get_browser()
+    browser_context = await browser.new_context()
+    try:
+        await asyncio.gather(*(scan_worker(browser_context) for _ in range(MANIFEST_SCAN_WORKERS)))
+    finally:
+        await browser_context.close()
+    # Workers finish out of order; keep the manifest in directory-listing order.
+    manifest_data = {f: manifest_data[f] for f in parser_files if f in manifest_data}
     
     if manifest_data:
         try:
-            with open(manifest_path, 'w', encoding='utf-8') as f:
-                json.dump(manifest_data, f, indent=2)
+            await asyncio.to_thread(Path(manifest_path).write_text, fastjson.dumps(manifest_data, indent=True), encoding='utf-8')
             await sent_message.edit_text(f"✅ Success! `parsers.json` has been generated with {len(manifest_data)} entries. You can now use the bot.")
         except Exception as e:
             await sent_message.edit_text(f"❌ ERROR: Could not write to `{manifest_path}`. Reason: {e}")
     else:
         await sent_message.edit_text("⚠️ Warning: No parsers were successfully processed. `parsers.json` was not created.")
 
+def _read_parser_file(filename: str, domains: list):
+    filepath = os.path.join(PARSERS_DIR, filename)
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            return {"filename": filename, "domains": domains, "script": f.read()}
+    except FileNotFoundError:
+        logger.error(f"Parser file '{filename}' from manifest not found at '{filepath}'.")
+        return None
+
+def _save_manifest_parsers(manifest: dict):
+    """
+    Saves every parser in a manifest, reading each script file only as the bulk writer
+    consumes it, so at most a few write chunks of scripts are in memory at once.
+    Blocking; run it in a worker thread. Returns (saved_count, read_count).
+    """
+    read_count = 0
+
+    def parsers():
+        nonlocal read_count
+        for filename, domains in manifest.items():
+            parser = _read_parser_file(filename, domains)
+            if parser is not None:
+                read_count += 1
+                yield parser
+
+    saved_count = save_parsers_from_repo(parsers())
+    return saved_count, read_count
+
 async def load_parsers_from_manifest():
     global PARSERS_LOADED
     logger.info("Starting parser load from manifest...")
     
-    def _sync_read_manifest_files():
-        manifest_path = 'parsers.json'
-        parsers_dir = os.path.abspath(os.path.join(REPO_DIR, "plugin", "js", "parsers"))
-        
-        with open(manifest_path, 'r', encoding='utf-8') as f:
-            manifest = json.load(f)
-        
-        parsers_to_save = []
-        for filename, domains in manifest.items():
-            filepath = os.path.join(parsers_dir, filename)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    script_content = f.read()
-                parsers_to_save.append({
-                    "filename": filename,
-                    "domains": domains,
-                    "script": script_content
-                })
-            except FileNotFoundError:
-                logger.error(f"Parser file '{filename}' from manifest not found at '{filepath}'.")
-        return parsers_to_save
-
     try:
-        parsers_to_save = await asyncio.to_thread(_sync_read_manifest_files)
-        if parsers_to_save:
-            await asyncio.to_thread(clean_all_parsers)
-            saved_count = await asyncio.to_thread(save_parsers_from_repo, parsers_to_save)
-            logger.info(f"✅ Successfully loaded {saved_count}/{len(parsers_to_save)} parsers from manifest into the database.")
+        manifest = await asyncio.to_thread(lambda: fastjson.loads(Path('parsers.json').read_bytes()))
+        saved_count, read_count = await asyncio.to_thread(_save_manifest_parsers, manifest)
+        if read_count:
+            logger.info(f"✅ Successfully loaded {saved_count}/{read_count} parsers from manifest into the database.")
             PARSERS_LOADED = True
         else:
             logger.warning("No parsers were loaded from the manifest. The database may be empty.")
-    except (FileNotFoundError, json.JSONDecodeError) as e:
+    except (FileNotFoundError, fastjson.JSONDecodeError) as e:
         logger.error(f"FATAL: Could not load from parsers.json. Please create it with /parserjson. Error: {e}")
         raise
 
@@ -180,66 +402,36 @@ async def load_parsers_from_json_content(json_content, sent_message):
     global PARSERS_LOADED
     logger.info("Loading parsers from provided JSON content...")
 
-    def _sync_prepare_parsers(content):
-        parsers_dir = os.path.abspath(os.path.join(REPO_DIR, "plugin", "js", "parsers"))
-        manifest = json.loads(content)
-        parsers_to_save = []
-        for filename, domains in manifest.items():
-            filepath = os.path.join(parsers_dir, filename)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    script_content = f.read()
-                parsers_to_save.append({
-                    "filename": filename,
-                    "domains": domains,
-                    "script": script_content
-                })
-            except FileNotFoundError:
-                logger.error(f"Parser file '{filename}' from manifest not found at '{filepath}'.")
-        return parsers_to_save
-
     try:
-        parsers_to_save = await asyncio.to_thread(_sync_prepare_parsers, json_content)
-        if parsers_to_save:
-            await asyncio.to_thread(clean_all_parsers)
-            saved_count = await asyncio.to_thread(save_parsers_from_repo, parsers_to_save)
-            logger.info(f"✅ Successfully loaded {saved_count}/{len(parsers_to_save)} parsers into the database.")
+        manifest = await asyncio.to_thread(fastjson.loads, json_content)
+        saved_count, read_count = await asyncio.to_thread(_save_manifest_parsers, manifest)
+        if read_count:
+            logger.info(f"✅ Successfully loaded {saved_count}/{read_count} parsers into the database.")
             await sent_message.edit_text(f"✅ Success! Loaded {saved_count} parsers into the database.")
             PARSERS_LOADED = True
         else:
             logger.warning("No parsers were successfully loaded from the provided JSON.")
             await sent_message.edit_text("⚠️ Warning: No parsers were loaded. Please check the file content.")
-    except json.JSONDecodeError as e:
+    except (fastjson.JSONDecodeError, UnicodeDecodeError) as e:
         logger.error(f"Invalid JSON provided: {e}")
         await sent_message.edit_text("❌ ERROR: The provided file is not valid JSON.")
         return
 
 async def run_parser_in_browser(page, parser_script, task_type):
-    dependency_scripts = _load_dependency_scripts()
-    if not dependency_scripts:
-        raise FileNotFoundError("Could not load dependency scripts for parser execution.")
-
-    loop = asyncio.get_running_loop()
-    future = loop.create_future()
-
-    async def set_result(result_json):
-        if not future.done():
-            future.set_result(json.loads(result_json))
-
-    await page.expose_function("sendResultToPython", set_result)
-
-    for script_content in dependency_scripts:
-        await page.add_script_tag(content=script_content)
-    
-    await page.evaluate("""
+    """
+    Runs a parser task on the loaded page. Pass parser_script=None when the page's
+    context was created with the parser compiled in (see borrow_chapter_context).
+    """
+    # evaluate() awaits the returned promise and hands back the result object itself.
+    return await asyncio.wait_for(page.evaluate("""
         async ([parserScript, task]) => {
             let result = { error: 'Unknown execution error' };
             try {
-                let activeParserInstance = null;
-                parserFactory.register = (domains, parser) => {
-                    activeParserInstance = new parser(document.URL, document);
-                };
-                eval(parserScript);
+                let ParserCtor = window.__wteParserCtor || null;
+                if (parserScript !== null) {
+                    ParserCtor = window.__wteCompileParser ? window.__wteCompileParser(parserScript) : null;
+                }
+                const activeParserInstance = ParserCtor ? new ParserCtor(document.URL, document) : null;
 
                 if (activeParserInstance) {
                     const parser = activeParserInstance;
@@ -262,33 +454,47 @@ async def run_parser_in_browser(page, parser_script, task_type):
                         }
                     }
                 } else {
-                    result = { error: 'No parser instance was registered or activated.' };
+                    result = { error: window.__wteParserError
+                        ? `Parser script failed to compile: ${window.__wteParserError}`
+                        : 'No parser instance was registered or activated.' };
                 }
             } catch (error) {
                 result = { error: `JavaScript execution crashed: ${error.toString()}`, stack: error.stack };
             }
-            window.sendResultToPython(JSON.stringify(result));
+            return result;
         }
-    """, [parser_script, task_type])
+    """, [parser_script, task_type]), timeout=30.0)
 
-    return await asyncio.wait_for(future, timeout=30.0)
+def _scrape_chapter_links(html_content: str, url: str):
+    """
+    Generic fallback when no parser handles the page: returns the page title and
+    every link whose text looks like a chapter, or the page itself as one chapter.
+    """
+    # selectolax parses in C; only the title and anchors are read, so a full BeautifulSoup tree isn't needed.
+    tree = HTMLParser(html_content)
+    title_node = tree.css_first('title')
+    title = ((title_node.text() if title_node else None) or 'Untitled').strip()
+    links = tree.css('a[href]')
+    chapters = [{'title': text, 'url': urljoin(url, link.attributes['href'])} for link in links if (text := link.text().strip()) and _CHAPTER_RE.search(text)]
+    if not chapters:
+        chapters = [{'title': "Full Page Content", 'url': url}]
+    return title, chapters
 
 async def get_chapter_list(url: str, user_id: int, context: CallbackContext):
     logger.info(f"Starting chapter list fetch for URL: {url}")
-    if not os.path.exists(CHROME_EXECUTABLE_PATH):
+    if not _chrome_executable_exists():
         raise FileNotFoundError(f"FATAL: Chrome executable not found at {CHROME_EXECUTABLE_PATH}")
     
     hostname = urlparse(url).hostname
     await log_to_channel(context, f"Searching for parser for domain: `{hostname}`")
-    repo_parser = await asyncio.to_thread(get_repo_parser, url)
+    repo_parser = await asyncio.to_thread(resolve_parser, user_id, url)
     
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(executable_path=CHROME_EXECUTABLE_PATH, args=['--no-sandbox', '--disable-setuid-sandbox', '--disable-dev-shm-usage'])
-        page = await browser.new_page()
+    browser_context = await new_browser_context()
+    try:
+        page = await new_page(browser_context)
         try:
-            await page.goto(url, wait_until='domcontentloaded', timeout=60000)
+            await page.goto(url, wait_until='domcontentloaded', timeout=30000)
         except Exception as e:
-            await browser.close()
             raise IOError(f"Failed to navigate to URL: {e}")
 
         if repo_parser:
@@ -297,12 +503,13 @@ async def get_chapter_list(url: str, user_id: int, context: CallbackContext):
                 result = await run_parser_in_browser(page, repo_parser['script'], 'getChapters')
                 
                 if result and 'error' not in result and result.get('type') == 'chapters' and result.get('chapters'):
-                    await browser.close()
                     chapters = result['chapters']
                     await log_to_channel(context, f"Successfully parsed {len(chapters)} chapters for title: '{result['title']}'")
                     for chapter in chapters:
-                        chapter['url'] = urljoin(url, chapter['url'])
-                        chapter['selected'] = True
+                        # A missing or relative URL still goes through urljoin, which falls back to the page URL.
+                        chapter_url = chapter.get('url')
+                        if not (isinstance(chapter_url, str) and chapter_url.startswith(('http://', 'https://'))):
+                            chapter['url'] = urljoin(url, chapter_url)
                     return result['title'], chapters, True
                 else:
                     error_details = result.get('error', 'Unknown error') if result else 'No result object returned'
@@ -315,62 +522,75 @@ async def get_chapter_list(url: str, user_id: int, context: CallbackContext):
 
         await log_to_channel(context, "Parser failed or not found. Falling back to generic scraping.")
         html_content = await page.content()
-        await browser.close()
-        soup = BeautifulSoup(html_content, 'html.parser')
-        title = (soup.find('title').string or 'Untitled').strip()
-        links = soup.find_all('a', href=True)
-        chapters = [{'title': link.text.strip(), 'url': urljoin(url, link['href']), 'selected': True} for link in links if link.text.strip() and re.search(r'chapter|ep\d+|ch\.\d+', link.text.lower(), re.I)]
-        if not chapters:
-            chapters = [{'title': "Full Page Content", 'url': url, 'selected': True}]
-        await log_to_channel(context, f"Generic scraping found {len(chapters)} potential chapters.")
-        return title, chapters, False
-
-async def create_epub_from_chapters(chapters: list, title: str, settings: dict):
-    final_filename = re.sub(r'[\\/*?:"<>|]', "", title)
-    book = epub.EpubBook()
-    book.set_identifier('id' + title); book.set_title(title); book.set_language('en'); book.add_author('WebToEpub Bot')
-    book_spine = ['nav']
-
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(executable_path=CHROME_EXECUTABLE_PATH, args=['--no-sandbox', '--disable-setuid-sandbox', '--disable-dev-shm-usage'])
-        for i, chapter_data in enumerate(chapters):
-            if not chapter_data.get('selected', False): continue
-            page = await browser.new_page()
-            try:
-                await page.goto(chapter_data['url'], wait_until='domcontentloaded', timeout=60000)
-                repo_parser = await asyncio.to_thread(get_repo_parser, chapter_data['url'])
-                chapter_html_content = ''
-                if repo_parser:
-                    try:
-                        result = await run_parser_in_browser(page, repo_parser['script'], 'getContent')
-                        if result and 'error' not in result and result.get('type') == 'content':
-                            chapter_html_content = result['html']
-                        else:
-                            error_details = result.get('error', 'Unknown error') if result else 'No result object'
-                            logger.error(f"Parser '{repo_parser['filename']}' failed to get content for '{chapter_data['title']}'. Reason: {error_details}. Falling back.")
+    finally:
+        await browser_context.close()
+
+    title, chapters = await asyncio.to_thread(_scrape_chapter_links, html_content, url)
+    await log_to_channel(context, f"Generic scraping found {len(chapters)} potential chapters.")
+    return title, chapters, False
+
+async def create_epub_from_chapters(chapters: list, title: str, settings: dict, user_id: int):
+    final_filename = title.translate(_UNSAFE_FILENAME_CHARS)
+    semaphore = asyncio.Semaphore(CHAPTER_FETCH_CONCURRENCY)
+
+    # Chapters almost always share one host, so resolve each host's parser once per book.
+    urls_by_host = {}
+    for chapter_data in chapters:
+        urls_by_host.setdefault(urlparse(chapter_data['url']).hostname, chapter_data['url'])
+    resolved = await asyncio.gather(*(asyncio.to_thread(resolve_parser, user_id, u) for u in urls_by_host.values()))
+    parsers_by_host = dict(zip(urls_by_host, resolved))
+    # Custom parsers share a filename across users, so the cache key carries a digest of the script itself.
+    cache_prefix_by_host = {
+        host: f"{p['filename']}|{hashlib.blake2b(p['script'].encode(), digest_size=16).hexdigest()}" if p else ''
+        for host, p in parsers_by_host.items()
+    }
+
+    settings = settings or {}
+    writer = EpubWriter(title, remove_images=bool(settings.get('remove_images')), remove_hyperlinks=bool(settings.get('remove_hyperlinks')))
+
+    async def fetch_chapter(i, chapter_data):
+        hostname = urlparse(chapter_data['url']).hostname
+        repo_parser = parsers_by_host[hostname]
+        # A different parser can extract different content from the same page.
+        cache_key = f"{cache_prefix_by_host[hostname]}|{chapter_data['url']}"
+        chapter_html_content = await asyncio.to_thread(_chapter_cache.get, cache_key)
+        if chapter_html_content is None:
+            async with semaphore, borrow_chapter_context(repo_parser) as browser_context:
+                page = await new_page(browser_context, CHAPTER_BLOCKED_RESOURCE_TYPES)
+                try:
+                    await page.goto(chapter_data['url'], wait_until='domcontentloaded', timeout=30000)
+                    chapter_html_content = ''
+                    if repo_parser:
+                        try:
+                            result = await run_parser_in_browser(page, None, 'getContent')
+                            if result and 'error' not in result and result.get('type') == 'content':
+                                chapter_html_content = result['html']
+                                # Only parser output is cached; a raw page may be a one-off error or challenge page.
+                                await asyncio.to_thread(_chapter_cache.set, cache_key, chapter_html_content, expire=CHAPTER_CACHE_TTL)
+                            else:
+                                error_details = result.get('error', 'Unknown error') if result else 'No result object'
+                                logger.error(f"Parser '{repo_parser['filename']}' failed to get content for '{chapter_data['title']}'. Reason: {error_details}. Falling back.")
+                                chapter_html_content = await page.content()
+                        except Exception as e:
+                            logger.error(f"Python-level exception getting content for '{chapter_data['title']}': {e}", exc_info=True)
                             chapter_html_content = await page.content()
-                    except Exception as e:
-                        logger.error(f"Python-level exception getting content for '{chapter_data['title']}': {e}", exc_info=True)
+                    else:
                         chapter_html_content = await page.content()
-                else:
-                    chapter_html_content = await page.content()
+                except Exception as e:
+                    logger.error(f"FATAL error processing chapter '{chapter_data['title']}': {e}", exc_info=True)
+                    return
+                finally:
+                    await page.close()
+
+        # Each chapter goes into the archive as soon as it is ready, so its HTML can be freed right away.
+        final_html = f"<h1>{chapter_data['title']}</h1>{chapter_html_content}"
+        try:
+            await asyncio.to_thread(writer.add_chapter, i, f'chap_{i+1}.xhtml', chapter_data['title'], final_html)
+        except Exception as e:
+            logger.error(f"Could not add chapter '{chapter_data['title']}' to the EPUB: {e}", exc_info=True)
 
-                final_html = f"<h1>{chapter_data['title']}</h1>{chapter_html_content}"
-                epub_chapter = epub.EpubHtml(title=chapter_data['title'], file_name=f'chap_{i+1}.xhtml', lang='en')
-                epub_chapter.content = final_html
-                book.add_item(epub_chapter)
-                book_spine.append(epub_chapter)
-            except Exception as e:
-                logger.error(f"FATAL error processing chapter '{chapter_data['title']}': {e}", exc_info=True)
-            finally:
-                await page.close()
-        await browser.close()
-    
-    book.spine = book_spine
-    book.toc = [(epub.Link(c.file_name, c.title, f"chap_{i+1}")) for i, c in enumerate(book.items) if isinstance(c, epub.EpubHtml)]
-    book.add_item(epub.EpubNcx()); book.add_item(epub.EpubNav())
-    epub_path = f"{final_filename}.epub"
-    
-    await asyncio.to_thread(epub.write_epub, epub_path, book, {})
-    
-    return epub_path, final_filename
+    # Chapters are written in completion order; the writer orders the spine and TOC by index.
+    await asyncio.gather(*(fetch_chapter(i, c) for i, c in enumerate(chapters)))
+    epub_bytes = await asyncio.to_thread(writer.finish)
+
+    return epub_bytes, final_filename
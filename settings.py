@@ -2,7 +2,10 @@ import logging
 import asyncio
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import CallbackContext, ConversationHandler
-from database import get_user_settings as db_get_settings, set_user_setting as db_set_setting, get_parser_count
+from database import (
+    get_user_settings as db_get_settings, update_and_get_user_settings as db_update_and_get_settings,
+    toggle_and_get_user_setting as db_toggle_and_get_setting, get_parser_count
+)
 
 logger = logging.getLogger(__name__)
 
@@ -11,14 +14,13 @@ SETTING_VALUE = 0
 
 # --- Settings Definition ---
 SETTINGS = {
-    'remove_hyperlinks': {'text': 'Remove Hyperlinks', 'type': 'toggle', 'default': True},
+    'remove_hyperlinks': {'text': 'Remove Hyperlinks', 'type': 'toggle', 'default': False},
     'remove_images': {'text': 'Remove Images', 'type': 'toggle', 'default': False},
 }
 DEFAULT_SETTINGS = {key: props['default'] for key, props in SETTINGS.items()}
 
-def get_user_settings(user_id: int) -> dict:
-    """Gets user settings from DB, providing defaults for missing values."""
-    settings = db_get_settings(user_id)
+def _with_defaults(settings: dict) -> dict:
+    """Fills in defaults for any settings missing from a stored settings document."""
     if not settings:
         return DEFAULT_SETTINGS.copy()
     
@@ -29,9 +31,19 @@ def get_user_settings(user_id: int) -> dict:
             
     return settings
 
-async def get_main_settings_menu(user_id: int):
-    """Creates the main settings menu keyboard and text."""
-    user_settings_sync = await asyncio.to_thread(get_user_settings, user_id)
+def get_user_settings(user_id: int) -> dict:
+    """Gets user settings from DB, providing defaults for missing values."""
+    return _with_defaults(db_get_settings(user_id))
+
+async def get_main_settings_menu(user_id: int, settings: dict = None):
+    """
+    Creates the main settings menu keyboard and text.
+    Pass `settings` when they were just fetched to skip reading them again.
+    """
+    if settings is None:
+        user_settings_sync = await asyncio.to_thread(get_user_settings, user_id)
+    else:
+        user_settings_sync = _with_defaults(settings)
     
     keyboard = []
     for key, props in SETTINGS.items():
@@ -52,14 +64,13 @@ async def handle_settings_callback(update: Update, context: CallbackContext):
     
     action, _, setting_key = query.data.partition('_')
 
+    updated_settings = None
     if action == 'toggle':
-        current_settings = await asyncio.to_thread(db_get_settings, user_id)
-        current_value = current_settings.get(setting_key, DEFAULT_SETTINGS.get(setting_key))
-        new_value = not current_value
-        await asyncio.to_thread(db_set_setting, user_id, setting_key, new_value)
+        # Flipped server-side, so two quick taps can't both read the same old value.
+        updated_settings = await asyncio.to_thread(db_toggle_and_get_setting, user_id, setting_key, bool(DEFAULT_SETTINGS.get(setting_key)))
     
     # Refresh the menu
-    reply_markup, message = await get_main_settings_menu(user_id)
+    reply_markup, message = await get_main_settings_menu(user_id, updated_settings)
     await query.edit_message_text(text=message, reply_markup=reply_markup)
 
 
@@ -73,11 +84,11 @@ async def handle_setting_value_input(update: Update, context: CallbackContext) -
         await update.message.reply_text("An error occurred. Please try again.")
         return ConversationHandler.END
 
-    await asyncio.to_thread(db_set_setting, user_id, setting, new_value)
+    updated_settings = await asyncio.to_thread(db_update_and_get_settings, user_id, setting, new_value)
     await update.message.reply_text(f"Setting `{setting}` updated successfully!")
     
     # Show the main menu again
-    reply_markup, message = await get_main_settings_menu(user_id)
+    reply_markup, message = await get_main_settings_menu(user_id, updated_settings)
     await update.message.reply_text(message, reply_markup=reply_markup)
     
     context.user_data.clear()